@@ -1,10 +1,22 @@
 import os
+import time
+import io
+import csv
+import re
+import json
+import asyncio
+import hashlib
+import httpx
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import streamlit as st
 import plotly.express as px
-import requests
-from sklearn.ensemble import IsolationForest
-from sklearn.cluster import KMeans
+import plotly.graph_objects as go
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.preprocessing import StandardScaler
 
 
 
@@ -38,127 +50,613 @@ st.markdown("""
 """)
 
 
-@st.cache_data
-def load_data():
-    # 1) 读取历史 Excel（GitHub raw）
-    excel_url = (
-        "https://raw.githubusercontent.com/"
-        "Zhengnan817/consumables-dashboard/"
-        "main/data/2023-2025.xlsx"
+EXCEL_URL = (
+    "https://raw.githubusercontent.com/"
+    "Zhengnan817/consumables-dashboard/"
+    "main/data/2023-2025.xlsx"
+)
+MONTHLY_API_URL = (
+    "https://api.github.com/repos/"
+    "Zhengnan817/consumables-dashboard/"
+    "contents/data/monthly"
+)
+COMMITS_API_URL = (
+    "https://api.github.com/repos/"
+    "Zhengnan817/consumables-dashboard/"
+    "commits"
+)
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+CACHE_VERSION = 7  # 缓存列结构变化时递增，使旧快照失效
+SNAPSHOT_TTL = 3600  # 快照在此时间内视为新鲜，冷启动不再访问网络
+ETAGS_PATH = os.path.join(CACHE_DIR, "etags.json")
+_MONEY_RE = re.compile(r"[\$,()]")
+
+KEEP_COLS = ["Date","Item","Description","Quantity","Price","Extension","Employee.1","Dept"]
+DTYPES = {
+    "Quantity": "float32",
+    "Price": "float32",
+    "Extension": "float32",
+    "Dept": "category",
+    "Item": "category",
+    "Description": "category",
+    "Employee.1": "category",
+}
+DEPT_MAP = {
+    "BTC":"BT","WTC":"WT","IM":"IM","QC AND NDT":"QC",
+    "MAINT":"MT","WH":"SCM","LOGI":"SCM"
+}
+# 月度 CSV 中的文本列固定为 string，避免各文件类型推断不一致
+CSV_COLUMN_TYPES = {
+    "Date": pa.string(),
+    "Item": pa.string(),
+    "Description": pa.string(),
+    "Employee.1": pa.string(),
+    "Dept": pa.string(),
+}
+CSV_DATE_FORMAT = "%m/%d/%Y"
+EXCLUDE_DEPTS = [
+    "KONE,CRANE PUEBLO",
+    "Portugal,Employee",
+    "Pueblo,HSE",
+    "Pueblo,Kitting"
+]
+
+
+async def _fetch(client, sem, url, etag=None):
+    async with sem:
+        r = await client.get(url, headers={"If-None-Match": etag} if etag else None)
+        if r.status_code != 304:
+            r.raise_for_status()
+        return r
+
+
+async def _download_sources(client, etags):
+    """Fetch the Excel, the monthly listing and every monthly CSV.
+
+    Sources with a known ETag are requested conditionally and may come back as
+    304 responses. Returns ``(excel_resp, csv_files, csv_resps)``; failures are
+    returned as exception objects in place of the response so the caller can
+    report them.
+    """
+    sem = asyncio.Semaphore(5)  # 限制并发，避免触发 GitHub 限流
+    excel, listing = await asyncio.gather(
+        _fetch(client, sem, EXCEL_URL, etags.get(EXCEL_URL)),
+        _fetch(client, sem, MONTHLY_API_URL),
+        return_exceptions=True,
+    )
+    if isinstance(listing, Exception):
+        return excel, listing, []
+    files = [
+        f for f in listing.json()
+        if f.get("type") == "file" and f.get("name", "").lower().endswith(".csv")
+    ]
+    resps = await asyncio.gather(
+        *[_fetch(client, sem, f["download_url"], etags.get(f["download_url"])) for f in files],
+        return_exceptions=True,
     )
+    return excel, files, resps
+
+
+async def _source_version(client):
+    """Hash the Excel ETag and the latest data/monthly commit SHA into a cache key."""
+    head, commits = await asyncio.gather(
+        client.head(EXCEL_URL),
+        client.get(COMMITS_API_URL, params={"path": "data/monthly", "per_page": 1}),
+    )
+    head.raise_for_status()
+    commits.raise_for_status()
+    etag = head.headers.get("ETag", "")
+    sha = commits.json()[0]["sha"]
+    return hashlib.sha1(f"{CACHE_VERSION}:{etag}:{sha}".encode()).hexdigest()[:16]
+
+
+def _snapshot_path(key):
+    return key and os.path.join(CACHE_DIR, f"consumables-v{CACHE_VERSION}-{key}.parquet")
+
+
+def _recent_snapshot():
+    """Newest snapshot for this CACHE_VERSION if written/confirmed within SNAPSHOT_TTL."""
     try:
-        df_old = pd.read_excel(excel_url, engine="openpyxl")
-    except Exception as e:
-        st.error(f"❗ loading histrocial Excel Failed：{e}")
-        return pd.DataFrame()
-    df_old.columns = df_old.columns.str.strip()
-    df_old["Date"] = pd.to_datetime(df_old["Date"], errors="coerce")
+        paths = [
+            e.path for e in os.scandir(CACHE_DIR)
+            if e.name.startswith(f"consumables-v{CACHE_VERSION}-") and e.name.endswith(".parquet")
+        ]
+    except OSError:
+        return None
+    if not paths:
+        return None
+    newest = max(paths, key=os.path.getmtime)
+    return newest if time.time() - os.path.getmtime(newest) < SNAPSHOT_TTL else None
+
+
+def _prune_snapshots(keep):
+    """Delete every combined snapshot except ``keep`` (older keys and CACHE_VERSIONs)."""
+    try:
+        entries = list(os.scandir(CACHE_DIR))
+    except OSError:
+        return
+    for e in entries:
+        if e.name.startswith("consumables-") and e.name.endswith(".parquet") and e.path != keep:
+            try:
+                os.remove(e.path)
+            except OSError:
+                pass
+
+
+async def _sync_sources(etags):
+    """Resolve the snapshot key and, on a miss, download the sources.
+
+    Everything goes through one HTTP/2 client so the version check and the
+    downloads share a single TCP/TLS connection to each host. Returns
+    ``(key, downloads)`` where ``downloads`` is ``None`` on a snapshot hit.
+    """
+    limits = httpx.Limits(max_connections=10, max_keepalive_connections=10)
+    async with httpx.AsyncClient(
+        http2=True,
+        timeout=30,
+        follow_redirects=True,
+        limits=limits,
+        headers={"Accept-Encoding": "gzip"},
+    ) as client:
+        try:
+            key = await _source_version(client)
+        except Exception:
+            key = None
+        path = _snapshot_path(key)
+        if path and os.path.exists(path):
+            return key, None
+        return key, await _download_sources(client, etags)
+
+
+def clean_num(frame, cols):
+    """Strip ``$ , ( )`` from ``cols`` in a single regex pass and parse as float32.
+
+    Columns the reader already typed as numeric skip the string round trip.
+    """
+    cols = [c for c in cols if c in frame.columns]
+    for col in [c for c in cols if pd.api.types.is_numeric_dtype(frame[c])]:
+        frame[col] = frame[col].astype("float32")
+        cols.remove(col)
+    if not cols:
+        return
+    stacked = pd.concat([frame[c].astype(str) for c in cols], keys=cols)
+    cleaned = pd.to_numeric(
+        stacked.str.replace(_MONEY_RE, "", regex=True),
+        errors="coerce",
+        downcast="float",
+    )
+    # 按位置拆回各列（空表时 .loc[col] 会因索引中没有该键而报错）
+    values = cleaned.to_numpy("float32").reshape(len(cols), len(frame))
+    for col, col_values in zip(cols, values):
+        frame[col] = col_values
+
+
+def _tidy(frame):
+    """Normalise one source frame: column names, Date, Dept and numeric columns."""
+    frame.columns = frame.columns.str.strip()
+    if not pd.api.types.is_datetime64_any_dtype(frame["Date"]):
+        frame["Date"] = pd.to_datetime(frame["Date"], errors="coerce")
+    # 先丢弃无日期的行（表头/汇总等），减少后续清洗的行数
+    frame = frame.dropna(subset=["Date"])
     # 兼容 Department 列
     for col in ("department","Department"):
-        if col in df_old.columns:
-            df_old.rename(columns={col: "Dept"}, inplace=True)
+        if col in frame.columns:
+            frame = frame.rename(columns={col: "Dept"})
             break
+    # 保留字段
+    frame = frame[[c for c in KEEP_COLS if c in frame.columns]].copy()
+    # 数值清洗
+    clean_num(frame, ("Quantity","Price","Extension"))
+    frame = frame.dropna(subset=["Quantity"])
+    # 标准化 Dept（先转 category，只对唯一值去空格、转大写并映射；空值保留为 NA）
+    if "Dept" in frame.columns:
+        dept = frame["Dept"].astype("category")
+        names = dept.cat.categories.astype(str).str.strip().str.upper()
+        names = names.map(lambda c: DEPT_MAP.get(c, c))
+        # 多个原始名称可能映射到同一部门（WH/LOGI → SCM），按名称合并编码
+        cats = names.unique()
+        codes = np.append(cats.get_indexer(names), -1)[dept.cat.codes.to_numpy()]  # -1 → NA
+        frame["Dept"] = pd.Categorical.from_codes(codes, categories=cats)
+    return frame
+
+
+def _source_cache_path(url):
+    name = hashlib.sha1(f"{CACHE_VERSION}:{url}".encode()).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, "sources", f"{name}.parquet")
+
+
+def _load_etags():
+    """Stored ETags, limited to sources whose tidied Parquet is still on disk."""
+    try:
+        with open(ETAGS_PATH) as fh:
+            etags = json.load(fh)
+    except (OSError, ValueError):
+        return {}
+    return {url: tag for url, tag in etags.items() if os.path.exists(_source_cache_path(url))}
 
-    # 2) 调用 GitHub API 列出 data/monthly 下的所有文件
-    api_url = (
-        "https://api.github.com/repos/"
-        "Zhengnan817/consumables-dashboard/"
-        "contents/data/monthly"
+
+def _prune_sources(urls, etags):
+    """Drop per-source Parquet files and ETags for URLs no longer being served."""
+    keep = {os.path.basename(_source_cache_path(u)) for u in urls}
+    try:
+        entries = list(os.scandir(os.path.join(CACHE_DIR, "sources")))
+    except OSError:
+        entries = []
+    for e in entries:
+        if e.name not in keep:
+            try:
+                os.remove(e.path)
+            except OSError:
+                pass
+    for url in set(etags) - set(urls):
+        del etags[url]
+
+
+def _load_source(url, resp, read, etags):
+    """Return the tidied frame for ``url``: from disk on 304, else parse and store."""
+    path = _source_cache_path(url)
+    if resp.status_code == 304:
+        return pd.read_parquet(path, engine="pyarrow")
+    frame = _tidy(read(resp.content))
+    etag = resp.headers.get("ETag")
+    if etag:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            frame.to_parquet(path, engine="pyarrow", compression="zstd")
+            etags[url] = etag
+        except (OSError, ValueError, TypeError):
+            pass
+    return frame
+
+
+def _excel_col(name):
+    """Only materialise the columns _tidy keeps (plus the Department alias)."""
+    return str(name).strip() in {*KEEP_COLS, "department", "Department"}
+
+
+def _read_excel(content):
+    # calamine（Rust）解析速度远快于 openpyxl；未安装时回退
+    try:
+        return pd.read_excel(io.BytesIO(content), engine="calamine", usecols=_excel_col)
+    except ImportError:
+        return pd.read_excel(io.BytesIO(content), engine="openpyxl", usecols=_excel_col)
+
+
+def _mangle_dupes(names):
+    """Rename repeated headers the way pandas does (Employee, Employee.1, ...)."""
+    seen = {}
+    out = []
+    for name in names:
+        n = seen.get(name, 0)
+        seen[name] = n + 1
+        out.append(f"{name}.{n}" if n else name)
+    return out
+
+
+def _csv_names(content):
+    """Canonical column names from the CSV header: stripped, de-duplicated, Department → Dept."""
+    header = next(csv.reader([content.split(b"\n", 1)[0].decode("utf-8-sig")]))
+    names = _mangle_dupes([h.strip() for h in header])
+    return ["Dept" if n in ("department", "Department") else n for n in names]
+
+
+def _read_csv(content):
+    # Arrow 多线程 C++ 解析器，比 pd.read_csv 快数倍；表头在解析前规范化，只解码需要的列
+    names = _csv_names(content)
+    tbl = pacsv.read_csv(
+        pa.BufferReader(content),
+        read_options=pacsv.ReadOptions(column_names=names, skip_rows=1),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=[c for c in KEEP_COLS if c in names],
+            column_types=CSV_COLUMN_TYPES,
+            strings_can_be_null=True,
+        ),
     )
+    # Date 先按 CSV_DATE_FORMAT 在 Arrow 中解析；其他格式的行回退到 pd.to_datetime，
+    # 仍无法解析的（汇总行等）置空，随后在 _tidy 中丢弃
+    raw = tbl["Date"]
+    date = pc.strptime(raw, format=CSV_DATE_FORMAT, unit="ns", error_is_null=True)
+    frame = tbl.set_column(tbl.column_names.index("Date"), "Date", date).to_pandas()
+    failed = pc.and_(pc.is_valid(raw), pc.is_null(date))
+    if pc.any(failed).as_py():
+        retry = pd.to_datetime(raw.filter(failed).to_pandas(), errors="coerce")
+        frame.loc[failed.to_numpy(zero_copy_only=False), "Date"] = retry.to_numpy()
+    return frame
+
+
+# cache_resource：大表只保留一份，重跑时不再反序列化拷贝；调用方只读不写
+@st.cache_resource(ttl=SNAPSHOT_TTL)
+def load_data():
+    # 0) 快照足够新时直接读取，连版本检查也跳过；
+    #    数据源未变化时读取本地 Parquet 快照，跳过下载与清洗；
+    #    否则并发下载历史 Excel、data/monthly 列表以及所有 CSV（带 ETag 条件请求）
+    recent = _recent_snapshot()
+    if recent:
+        return pd.read_parquet(recent, engine="pyarrow")
+    etags = _load_etags()
+    key, downloads = asyncio.run(_sync_sources(etags))
+    cache_path = _snapshot_path(key)
+    if downloads is None:
+        try:
+            os.utime(cache_path)  # 已与远端核对，刷新新鲜度
+        except OSError:
+            pass
+        return pd.read_parquet(cache_path, engine="pyarrow")
+    excel_resp, files, resps = downloads
+
+    # 1) 读取历史 Excel（GitHub raw；304 时读取本地快照）
     try:
-        files = requests.get(api_url).json()
+        if isinstance(excel_resp, Exception):
+            raise excel_resp
+        df_old = _load_source(EXCEL_URL, excel_resp, _read_excel, etags)
     except Exception as e:
-        st.error(f"❗ GitHub API 调用失败：{e}")
+        st.error(f"❗ loading histrocial Excel Failed：{e}")
+        return pd.DataFrame()
+
+    # 2) 调用 GitHub API 列出 data/monthly 下的所有文件
+    if isinstance(files, Exception):
+        st.error(f"❗ GitHub API 调用失败：{files}")
         return pd.DataFrame()
 
-    # 3) 筛出所有 .csv 并用 download_url 读取
+    # 3) 解析已下载的 .csv
     df_new_list = []
-    for f in files:
-        if f.get("type") == "file" and f.get("name","").lower().endswith(".csv"):
-            url = f["download_url"]
-            try:
-                df = pd.read_csv(url)
-            except Exception as e:
-                st.error(f"❗ 加载 CSV {f['name']} 失败：{e}")
-                continue
-            df.columns = df.columns.str.strip()
-            df["Date"] = pd.to_datetime(df["Date"], errors="coerce")
-            if "Department" in df.columns:
-                df.rename(columns={"Department": "Dept"}, inplace=True)
-            df_new_list.append(df)
+    failed = False  # 有文件失败时不写快照，避免不完整数据被长期复用
+    for f, resp in zip(files, resps):
+        try:
+            if isinstance(resp, Exception):
+                raise resp
+            df = _load_source(f["download_url"], resp, _read_csv, etags)
+        except Exception as e:
+            st.error(f"❗ 加载 CSV {f['name']} 失败：{e}")
+            failed = True
+            continue
+        df_new_list.append(df)
 
     if not df_new_list:
         st.error("❗ 没有找到任何 CSV 文件")
         return pd.DataFrame()
     df_new = pd.concat(df_new_list, ignore_index=True)
 
-    # 4) 保留字段
-    keep = ["Date","Item","Description","Quantity","Price","Extension","Employee.1","Dept"]
-    df_old = df_old[[c for c in keep if c in df_old.columns]]
-    df_new = df_new[[c for c in keep if c in df_new.columns]]
+    # 清理已从列表中移除的 CSV（以及旧 CACHE_VERSION）留下的源缓存与 ETag
+    _prune_sources([EXCEL_URL] + [f["download_url"] for f in files], etags)
+    try:
+        with open(ETAGS_PATH, "w") as fh:
+            json.dump(etags, fh)
+    except OSError:
+        pass
 
-    # 5) 数值清洗
-    def clean_num(s):
-        return pd.to_numeric(
-            s.astype(str).str.replace(r"[\$,()]", "", regex=True),
-            errors="coerce"
-        )
-    for frame in (df_old, df_new):
-        for col in ("Quantity","Price","Extension"):
-            if col in frame.columns:
-                frame[col] = clean_num(frame[col])
-
-    # 6) 标准化 Dept
-    dept_map = {
-        "BTC":"BT","WTC":"WT","IM":"IM","QC AND NDT":"QC",
-        "MAINT":"MT","WH":"SCM","LOGI":"SCM"
-    }
-    for frame in (df_old, df_new):
-        if "Dept" in frame.columns:
-            frame["Dept"] = (
-                frame["Dept"].astype(str)
-                         .str.strip()
-                         .replace(dept_map)
-            )
-
-    # 7) 合并 & 保留所有记录（包含 Extension 和 Dept 的空值）
-    # df = pd.concat([df_old, df_new], ignore_index=True)
-    # df = df.dropna(subset=["Date", "Quantity"])  # 只过滤日期和数量，保留 Extension 和 Dept 空值
-    # return df
-    # 7) 合并 & 过滤
+    # 4) 合并 & 过滤
     df = pd.concat([df_old, df_new], ignore_index=True)
 
-    # 排除无效或非目标部门数据
-    exclude_depts = [
-        "KONE,CRANE PUEBLO",
-        "Portugal,Employee",
-        "Pueblo,HSE",
-        "Pueblo,Kitting"
-    ]
-    df = df[~df["Dept"].isin(exclude_depts)]
-    return df.dropna(subset=["Date", "Quantity"])
+    # 月份列只计算一次（月初 datetime64），后续过滤/分组直接比较整数时间戳
+    df["Month"] = df["Date"].to_numpy().astype("datetime64[M]")
+
+    # 数值列统一为 float32；低基数字符串列转为 category（groupby 直接使用整数编码）
+    df = df.astype({c: t for c, t in DTYPES.items() if c in df.columns})
+
+    # 排除无效或非目标部门数据（在类别上判断一次，再按整数编码取行；空部门保留）
+    excluded = df["Dept"].cat.categories.isin([d.upper() for d in EXCLUDE_DEPTS])
+    df = df[~np.append(excluded, False)[df["Dept"].cat.codes.to_numpy()]]
+
+    if cache_path and not failed:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            df.to_parquet(cache_path, engine="pyarrow", compression="zstd")
+        except OSError:
+            pass
+        else:
+            _prune_snapshots(keep=cache_path)
+    return df
+
+
+@st.cache_data
+def build_aggs(df):
+    """Small monthly / department / item / employee aggregates shared by every page.
+
+    Everything is rolled up from one grouped pass over ``df`` keyed by
+    (Month, Dept, Employee.1, Item); only the small rollups are returned.
+    """
+    cube = df.groupby(
+        ["Month", "Dept", "Employee.1", "Item"], dropna=False, observed=True
+    ).agg(
+        Quantity=("Quantity", "sum"),
+        Extension=("Extension", "sum"),
+        Txn_Count=("Extension", "count"),
+    )
+    # 月 × 部门支出宽表（空部门记为 Unassigned），各页面的趋势与部门饼图直接切片
+    monthly = (
+        cube["Extension"]
+        .groupby(level=["Month", "Dept"], dropna=False, observed=True)
+        .sum()
+        .unstack("Dept")
+    )
+    monthly.columns = monthly.columns.add_categories("Unassigned").fillna("Unassigned")
+
+    # 各部门最近一个月的明细（员工 × 物品）
+    last_month = (
+        monthly.drop(columns="Unassigned", errors="ignore")
+        .apply(pd.Series.last_valid_index)
+    )
+    last_rows = pd.concat(
+        {d: cube.xs((m, d), level=["Month", "Dept"]) for d, m in last_month.items()},
+        names=["Dept"],
+    )
+
+    # 页面 KPI：float64 累加以保留到分；Overview 对应全体记录
+    vals = df[["Quantity", "Extension"]].astype("float64").assign(
+        Records=1, Missing=df["Extension"].isna()
+    )
+    kpis = vals.groupby(df["Dept"].astype(object)).sum()
+    kpis.loc["Overview"] = vals.sum()
+    return {
+        "kpis": kpis,
+        "monthly": monthly,
+        "top_items": (
+            cube.groupby(level="Item", observed=True)[["Quantity", "Extension"]]
+            .sum(min_count=1)
+        ),
+        "by_dept_item": (
+            cube.groupby(level=["Dept", "Item"], observed=True)[["Quantity", "Extension"]]
+            .sum()
+        ),
+        "last_month": last_month,
+        "last_items": (
+            last_rows.groupby(level=["Dept", "Item"], observed=True)[["Quantity", "Extension"]]
+            .sum()
+        ),
+        "last_emp": (
+            last_rows.groupby(level=["Dept", "Employee.1"], observed=True)[["Extension", "Txn_Count"]]
+            .sum()
+            .rename(columns={"Extension": "Total_Spend"})
+        ),
+        "last_emp_item": (
+            last_rows.groupby(level=["Dept", "Employee.1", "Item"], observed=True)
+            [["Quantity", "Extension", "Txn_Count"]]
+            .sum()
+            .rename(columns={"Extension": "Total_Spend"})
+        ),
+    }
+
+
+def top_n(s, n=10):
+    """``s.nlargest(n)`` via partition-based selection: O(len), only the top n sorted.
+
+    Ties keep their original order, as with ``nlargest``; NaNs are dropped.
+    """
+    vals = np.nan_to_num(s.to_numpy("float64", na_value=np.nan), nan=-np.inf)
+    if len(vals) > n:
+        kth = np.partition(vals, -n)[-n]  # n-th largest value
+        above = np.flatnonzero(vals > kth)
+        ties = np.flatnonzero(vals == kth)[: n - len(above)]
+        idx = np.concatenate([above, ties])
+    else:
+        idx = np.arange(len(vals))
+    idx = idx[np.lexsort((idx, -vals[idx]))]
+    return s.iloc[idx[vals[idx] > -np.inf]]
+
+
+def flag_high_spenders(x, threshold=3.5):
+    """Flag spend above ``median + threshold`` robust standard deviations.
+
+    The robust deviation is 1.4826 x MAD, falling back to the mean absolute
+    deviation when more than half the employees share the median spend.
+    """
+    med = np.median(x)
+    dev = np.abs(x - med)
+    scale = 1.4826 * np.median(dev) or 1.2533 * dev.mean()
+    return x > med + threshold * scale
+
+
+@st.cache_resource
+def fit_kmeans(feat_bytes):
+    """Fit the 3-cluster model once per distinct (Total_Spend, Txn_Count) matrix.
+
+    Features are standardised first so dollar spend does not swamp the
+    transaction count; ``cluster_centers_`` are therefore in standard units.
+    """
+    x = np.frombuffer(feat_bytes, dtype=np.float32).reshape(-1, 2)
+    return MiniBatchKMeans(
+        n_clusters=3,
+        batch_size=min(64, len(x)),
+        n_init=3,
+        max_iter=50,
+        random_state=42,
+    ).fit(StandardScaler().fit_transform(x))
+
+
+# 图表构建结果按（很小的）聚合输入缓存，重跑时跳过 plotly express 构图
+@st.cache_data(show_spinner=False)
+def trend_fig(monthly, line=True):
+    """Monthly spending bar chart, optionally with a trend line, as a plotly dict."""
+    fig = px.bar(
+        monthly, x="Date", y="Extension", text_auto=".2s",
+        labels={"Extension": "Spending ($)"}
+    )
+    if line:
+        fig.add_scatter(
+            x=monthly["Date"], y=monthly["Extension"],
+            mode="lines+markers", name="Trend"
+        )
+    return fig.to_dict()
+
+
+@st.cache_data(show_spinner=False)
+def pie_fig(values, hole=None, height=None):
+    """Pie chart of ``values`` (index = slice label) as a plotly dict."""
+    fig = go.Figure(go.Pie(
+        labels=values.index, values=values.values, hole=hole,
+        textinfo="percent+label",
+        hovertemplate="label=%{label}<br>value=%{value}<extra></extra>",
+    ), layout={"margin": {"t": 60}})  # 与 px.pie 默认版式一致
+    if height:
+        fig.update_layout(height=height)
+    return fig.to_dict()
+
+
+@st.cache_data(show_spinner=False)
+def anomaly_fig(anomalies, month_label):
+    fig = px.bar(
+        anomalies.sort_values("Total_Spend"),
+        x="Total_Spend",
+        y="Employee.1",
+        orientation="h",
+        text="Total_Spend",
+        color="Total_Spend",              # 你也可以只用大小编码
+        labels={"Total_Spend":"Spend ($)", "Employee.1":"Employee"},
+        title=f"🚩 Anomalous Spenders — {month_label}"
+    )
+    fig.update_layout(yaxis={"categoryorder":"total ascending"})
+    return fig.to_dict()
+
+
+@st.cache_data(show_spinner=False)
+def cluster_fig(emp_feats, month_label):
+    # use friendly “Cluster_Label” instead of raw “Cluster”
+    fig = px.scatter(
+        emp_feats,
+        x="Txn_Count",
+        y="Total_Spend",
+        color="Cluster_Label",
+        hover_data=["Employee.1"],
+        labels={
+            "Txn_Count":    "Transaction Count",
+            "Total_Spend":   "Total Spend ($)",
+            "Cluster_Label":"Segment"
+        },
+        title=f"Employee Clusters — {month_label}"
+    )
+    fig.update_layout(legend_title_text="Segment")
+    return fig.to_dict()
+
+
+# 年份切换只重跑该片段，不重建整页
+@st.fragment
+def year_chart(mono, years):
+    sel_year = st.selectbox("Year", years, index=len(years) - 1)
+    fig_year = trend_fig(mono.loc[str(sel_year)].reset_index(), line=False)
+    st.plotly_chart(fig_year, use_container_width=True)
 
 
 # Load data
 df = load_data()
 if df.empty:
     st.stop()
+aggs = build_aggs(df)
 
 
 # Page selection
 pages = ["Overview", "BT", "WT", "IM", "QC", "MT", "SCM"]
 page = st.sidebar.radio("Select View", pages)
 
-df_page = df if page == "Overview" else df[df["Dept"] == page]
-
 # Page title
 title = page if page != "Overview" else "Overview"
 st.title(title)
 
 # Common KPIs（包含所有 Extension 值，空值视为0）
-total_qty = df_page["Quantity"].fillna(0).sum()
-total_val = df_page["Extension"].fillna(0).sum()
-total_records = df_page.shape[0]
+kpi = aggs["kpis"].reindex([page], fill_value=0).iloc[0]
+total_qty = kpi["Quantity"]
+total_val = kpi["Extension"]
+total_records = int(kpi["Records"])
 
 # Display metrics
 c1, c2, c3 = st.columns(3)
@@ -167,85 +665,33 @@ c2.metric("Total Quantity", f"{total_qty:,.0f}")
 c3.metric("Total Records", total_records)
 
 # ⚠️ 备注说明空值处理
-if df_page["Extension"].isna().sum() > 0:
+if kpi["Missing"] > 0:
     st.caption("⚠️ Note: Some records are missing cost data (Extension). These are treated as $0 in totals.")
 
 
 
 
 if page == "Overview":
-    # prepare data for all charts
-    mono = (
-    df
-    .groupby(df["Date"].dt.to_period("M"), dropna=False)["Extension"]
-    .sum(min_count=1)  # 保留空值记录
-    .reset_index()
-    )
-    mono["Date"] = mono["Date"].dt.to_timestamp()
-    years = sorted(df["Date"].dt.year.unique())
+    # prepare data for all charts（均取自缓存的 aggs）
+    mono = aggs["monthly"].sum(axis=1).rename_axis("Date").rename("Extension")
+    last_month = mono.index.max()
+    years = sorted(mono.index.year.unique())
     default_year = years[-1]
-    df_year = df[df["Date"].dt.year == default_year]
-    monthly = (
-        df_year
-        .groupby(df_year["Date"].dt.to_period("M"))["Extension"]
-        .sum()
-        .reset_index()
-    )
-    monthly["Date"] = monthly["Date"].dt.to_timestamp()
-    last_period = df_year["Date"].dt.to_period("M").max()
-    df_last = df_year[df_year["Date"].dt.to_period("M") == last_period]
 
     # top 10 all-time
-    top_q = (
-    df.groupby("Item")["Quantity"]
-    .sum(min_count=1)
-    .nlargest(10)
-    )
-    top_e = (
-        df.groupby("Item")["Extension"]
-        .sum(min_count=1)
-        .nlargest(10)
-    )
+    top_q = top_n(aggs["top_items"]["Quantity"])
+    top_e = top_n(aggs["top_items"]["Extension"])
 
     top_q.index = [f"{i+1}. {item}" for i, item in enumerate(top_q.index)]
     top_e.index = [f"{i+1}. {item}" for i, item in enumerate(top_e.index)]
 
     # build figures
-    fig_all = px.bar(
-        mono, x="Date", y="Extension", text_auto=".2s",
-        labels={"Extension": "Spending ($)"}
-    )
-    fig_all.add_scatter(
-        x=mono["Date"], y=mono["Extension"],
-        mode="lines+markers", name="Trend"
-    )
-
-    fig_year = px.bar(
-        monthly, x="Date", y="Extension", text_auto=".2s",
-        labels={"Extension": "Spending ($)"}
-    )
+    fig_all = trend_fig(mono.reset_index())
 
-    dp = (
-    df_last
-    .groupby("Dept", dropna=False)["Extension"]
-    .sum(min_count=1)
-    .reset_index()
-    )
-    dp["Dept"] = dp["Dept"].fillna("Unassigned")  # 填充空值标签
-    fig_dep = px.pie(
-        dp, names="Dept", values="Extension", hole=0.2
-    )
+    fig_dep = pie_fig(aggs["monthly"].loc[last_month].dropna(), hole=0.2, height=500)
 
-    fig_dep = px.pie(
-        dp, names="Dept", values="Extension", hole=0.2
-    )
-    fig_dep.update_traces(textinfo="percent+label")
-    fig_dep.update_layout(height=500)
-
-    fig_u = px.pie(names=top_q.index, values=top_q.values)
-    fig_u.update_traces(textinfo="percent+label")
-    fig_c = px.pie(names=top_e.index, values=top_e.values)
-    fig_c.update_traces(textinfo="percent+label")
+    fig_u = pie_fig(top_q)
+    fig_c = pie_fig(top_e)
 
     # render as tabs
     tabs = st.tabs(["Trend", "By Year", "Dept Share", "Top Items"])
@@ -256,38 +702,15 @@ if page == "Overview":
 
     with tabs[1]:
         st.header(f"{default_year} Monthly Spending")
-        sel_year = st.selectbox("Year", years, index=len(years) - 1)
-        # update yearly chart if user selects a different year
-        df_year = df[df["Date"].dt.year == sel_year]
-        monthly = (
-            df_year
-            .groupby(df_year["Date"].dt.to_period("M"))["Extension"]
-            .sum()
-            .reset_index()
-        )
-        monthly["Date"] = monthly["Date"].dt.to_timestamp()
-        fig_year = px.bar(
-            monthly, x="Date", y="Extension", text_auto=".2s",
-            labels={"Extension": "Spending ($)"}
-        )
-        st.plotly_chart(fig_year, use_container_width=True)
+        year_chart(mono, years)
 
     with tabs[2]:
-        month_label = last_period.to_timestamp().strftime("%B %Y")
+        month_label = last_month.strftime("%B %Y")
         st.header(f"Dept Spending Comparison — Overall vs {month_label}")
 
         # 计算 Overall（总时间段）部门支出
-        dept_overall = (
-            df[df["Dept"].notna()]
-            .groupby("Dept")["Extension"]
-            .sum()
-            .reset_index()
-        )
-        fig_dep_overall = px.pie(
-            dept_overall, names="Dept", values="Extension", hole=0.2
-        )
-        fig_dep_overall.update_traces(textinfo="percent+label")
-        fig_dep_overall.update_layout(height=500)
+        dept_overall = aggs["monthly"].drop(columns="Unassigned", errors="ignore").sum()
+        fig_dep_overall = pie_fig(dept_overall, hole=0.2, height=500)
 
         # 当前月 Pie Chart 已在前面定义为 fig_dep
         col1, col2 = st.columns(2)
@@ -316,124 +739,65 @@ if page == "Overview":
 # Department-specific pages
 else:
     # 1) overall trend
-    dept_trend = (
-        df_page
-        .groupby(df_page["Date"].dt.to_period("M"))["Extension"]
-        .sum()
-        .reset_index()
-    )
-    dept_trend["Date"] = dept_trend["Date"].dt.to_timestamp()
-    fig_trend = px.bar(
-        dept_trend,
-        x="Date", y="Extension",
-        text_auto=".2s",
-        labels={"Extension":"Spending ($)"}
-    )
-    fig_trend.add_scatter(
-        x=dept_trend["Date"],
-        y=dept_trend["Extension"],
-        mode="lines+markers",
-        name="Trend"
-    )
+    dept_trend = aggs["monthly"][page].dropna().rename_axis("Date").rename("Extension")
+    fig_trend = trend_fig(dept_trend.reset_index())
 
     # 2) all-time top-10 items
-    top_q = df_page.groupby("Item")["Quantity"].sum().nlargest(10)
-    top_e = df_page.groupby("Item")["Extension"].sum().nlargest(10)
+    top_q = top_n(aggs["by_dept_item"].loc[page, "Quantity"])
+    top_e = top_n(aggs["by_dept_item"].loc[page, "Extension"])
     top_q.index = [f"{i+1}. {item}" for i,item in enumerate(top_q.index)]
     top_e.index = [f"{i+1}. {item}" for i,item in enumerate(top_e.index)]
-    fig_q = px.pie(names=top_q.index, values=top_q.values)
-    fig_q.update_traces(textinfo="percent+label")
-    fig_e = px.pie(names=top_e.index, values=top_e.values)
-    fig_e.update_traces(textinfo="percent+label")
+    fig_q = pie_fig(top_q)
+    fig_e = pie_fig(top_e)
 
     # 3) latest-month top-10 items
-    last_period = df_page["Date"].dt.to_period("M").max()
-    month_label = last_period.to_timestamp().strftime("%B %Y")
-    df_last = df_page[df_page["Date"].dt.to_period("M") == last_period]
-    top_q_last = df_last.groupby("Item")["Quantity"].sum().nlargest(10)
-    top_e_last = df_last.groupby("Item")["Extension"].sum().nlargest(10)
+    last_month = aggs["last_month"][page]
+    month_label = last_month.strftime("%B %Y")
+    top_q_last = top_n(aggs["last_items"].loc[page, "Quantity"])
+    top_e_last = top_n(aggs["last_items"].loc[page, "Extension"])
     top_q_last.index = [f"{i+1}. {item}" for i,item in enumerate(top_q_last.index)]
     top_e_last.index = [f"{i+1}. {item}" for i,item in enumerate(top_e_last.index)]
-    fig_qm = px.pie(names=top_q_last.index, values=top_q_last.values)
-    fig_qm.update_traces(textinfo="percent+label")
-    fig_em = px.pie(names=top_e_last.index, values=top_e_last.values)
-    fig_em.update_traces(textinfo="percent+label")
-
-
-    # 5) 当月每个员工的总消费
-        # 5) 当月每个员工的总消费 & 异常检测
-    df_em = df_page[df_page["Date"].dt.to_period("M") == last_period]
-    emp_spend = (
-        df_em
-        .groupby("Employee.1")["Extension"]
-        .sum()
-        .reset_index(name="Total_Spend")
-    )
+    fig_qm = pie_fig(top_q_last)
+    fig_em = pie_fig(top_e_last)
+
+
+    # 5) 当月每个员工的总消费 & 异常检测
+    emp_last = aggs["last_emp"].loc[page].reset_index()
+    emp_spend = emp_last[["Employee.1", "Total_Spend"]]
     # 过滤掉无效行
     emp_spend = emp_spend[emp_spend["Total_Spend"] > 0]
 
     if not emp_spend.empty:
-        from sklearn.ensemble import IsolationForest
-        iso = IsolationForest(contamination=0.05, random_state=42)
-        emp_spend["anomaly_flag"] = iso.fit_predict(emp_spend[["Total_Spend"]])
+        spend = emp_spend["Total_Spend"].to_numpy("float64")
+        emp_spend["anomaly_flag"] = np.where(flag_high_spenders(spend), -1, 1)
         emp_spend["Anomaly"] = emp_spend["anomaly_flag"] == -1
 
         # 只保留异常员工
         anomalies = emp_spend[emp_spend["Anomaly"]]
 
         # 准备画图
-        fig_emp = px.bar(
-            anomalies.sort_values("Total_Spend"),
-            x="Total_Spend",
-            y="Employee.1",
-            orientation="h",
-            text="Total_Spend",
-            color="Total_Spend",              # 你也可以只用大小编码
-            labels={"Total_Spend":"Spend ($)", "Employee.1":"Employee"},
-            title=f"🚩 Anomalous Spenders — {month_label}"
-        )
-        fig_emp.update_layout(yaxis={"categoryorder":"total ascending"})
+        fig_emp = anomaly_fig(anomalies, month_label)
     else:
         anomalies = pd.DataFrame()  # 为空
 
-# Prepare employee features for clustering
-    df_em = df_page[df_page["Date"].dt.to_period("M") == last_period]
-    emp_feats = (
-        df_em
-        .groupby("Employee.1")
-        .agg(
-            Total_Spend=("Extension", "sum"),
-            Txn_Count=("Extension", "count")
-        )
-        .reset_index()
-    )
+    # Prepare employee features for clustering
+    emp_feats = emp_last
 
     # Only keep employees with nonzero activity
     emp_feats = emp_feats[(emp_feats["Total_Spend"] > 0) & (emp_feats["Txn_Count"] > 0)]
 
     # Run KMeans to identify 3 clusters
-        # Run KMeans …
-    kmeans = KMeans(n_clusters=3, random_state=42).fit(emp_feats[["Total_Spend","Txn_Count"]])
+    feats = emp_feats[["Total_Spend","Txn_Count"]].to_numpy(np.float32)
+    kmeans = fit_kmeans(feats.tobytes())
     emp_feats["Cluster"] = kmeans.labels_.astype(str)
 
     # ──> Insert friendly‐label mapping here:
-    # 1) compute centroid summary
-    centroids = pd.DataFrame(
-        kmeans.cluster_centers_,
-        columns=["Total_Spend","Txn_Count"]
-    ).assign(Cluster=lambda df: df.index.astype(str))
-
-    # 2) pick extremes
-    hf_ls = (
-        centroids
-        .sort_values(["Txn_Count","Total_Spend"], ascending=[False,True])
-        .iloc[0]["Cluster"]
-    )
-    lf_hs = (
-        centroids
-        .sort_values(["Txn_Count","Total_Spend"], ascending=[True,False])
-        .iloc[0]["Cluster"]
-    )
+    # 1) centroid summary: (k, 2) array of standardised [Total_Spend, Txn_Count]
+    C = kmeans.cluster_centers_
+
+    # 2) pick extremes (lexsort: last key is primary)
+    hf_ls = str(np.lexsort((C[:, 0], -C[:, 1]))[0])  # max count, then min spend
+    lf_hs = str(np.lexsort((-C[:, 0], C[:, 1]))[0])  # min count, then max spend
 
     # 3) build label map (others → mid‐range)
     label_map = {
@@ -448,40 +812,11 @@ else:
     emp_feats["Cluster_Label"] = emp_feats["Cluster"].map(label_map)
 
     # ──> now build fig_cluster using “Cluster_Label” instead of raw “Cluster”:
-    fig_cluster = px.scatter(
-        emp_feats,
-        x="Txn_Count",
-        y="Total_Spend",
-        color="Cluster_Label",               # ← use friendly labels
-        hover_data=["Employee.1"],
-        labels={
-            "Txn_Count":    "Transaction Count",
-            "Total_Spend":   "Total Spend ($)",
-            "Cluster_Label":"Segment"
-        },
-        title=f"Employee Clusters — {last_period.strftime('%B %Y')}"
-    )
-    fig_cluster.update_layout(legend_title_text="Segment")
+    fig_cluster = cluster_fig(emp_feats, month_label)
 
-    lowfreq_highspend_cluster = (
-    centroids
-    .sort_values(["Txn_Count", "Total_Spend"], ascending=[True, False])
-    .iloc[0]["Cluster"]
-    )
-    centroids = pd.DataFrame(
-    kmeans.cluster_centers_,
-    columns=["Total_Spend", "Txn_Count"]
-    ).assign(Cluster=lambda d: d.index.astype(str))
-
-    # Sort by Txn_Count descending, then by Total_Spend ascending
-    highfreq_lowspend_cluster = (
-        centroids
-        .sort_values(["Txn_Count", "Total_Spend"], ascending=[False, True])
-        .iloc[0]["Cluster"]
-    )
     # Get employee lists
-    highfreq = emp_feats[emp_feats["Cluster"] == highfreq_lowspend_cluster]["Employee.1"]
-    lowfreq  = emp_feats[emp_feats["Cluster"] == lowfreq_highspend_cluster]["Employee.1"]
+    highfreq = emp_feats[emp_feats["Cluster"] == hf_ls]["Employee.1"]
+    lowfreq  = emp_feats[emp_feats["Cluster"] == lf_hs]["Employee.1"]
 
 
     # 6) raw data table for anomalies only
@@ -527,16 +862,16 @@ else:
             st.plotly_chart(fig_em, use_container_width=True)
 
     with tabs[3]:
-        st.header(f"Employee Anomalies & Spend Table — {last_period.to_timestamp().strftime('%B %Y')}")
+        st.header(f"Employee Anomalies & Spend Table — {month_label}")
 
         # Human-friendly explanation
         st.markdown(
             """
             **How these anomalies are identified**  
-            • We use an Isolation Forest from machine learning, an automated method that spots employees whose monthly spend  
-            stands out from the rest.  
+            • We use a robust statistical rule: an employee is flagged when their monthly spend is more than  
+            3.5 robust standard deviations (based on the median absolute deviation) above the department median.  
             • “Anomalous” here is relative—if someone’s total spend is much higher than peers,  
-            the model flags them.  
+            the rule flags them.  
 
             **Please note:**  
             This is just a *reference*—department managers should review each flagged employee  
@@ -551,9 +886,7 @@ else:
             st.info("No anomalous spenders detected for this month.")
 
     with tabs[4]:
-        # Example
-        last_period = df_page["Date"].dt.to_period("M").max()
-        st.header(f"Employee Clustering — {last_period.to_timestamp().strftime('%B %Y')}")
+        st.header(f"Employee Clustering — {month_label}")
 
         
         st.markdown(
@@ -568,20 +901,9 @@ else:
 
         st.subheader("High-Frequency, Low-Spend — Purchase Details (>$200 & >5 transactions)")
 
-        # 获取属于高频低额群体的员工消费记录
-        df_high_items = df_em[df_em["Employee.1"].isin(highfreq)]
-
-        # 聚合数据：每位员工对每个物品的消费频次与金额
-        high_details = (
-            df_high_items
-            .groupby(["Employee.1", "Item"])
-            .agg(
-                Quantity=("Quantity", "sum"),
-                Total_Spend=("Extension", "sum"),
-                Txn_Count=("Extension", "count")
-            )
-            .reset_index()
-        )
+        # 每位员工对每个物品的消费频次与金额（取自预聚合），只保留高频低额群体
+        high_details = aggs["last_emp_item"].loc[page].reset_index()
+        high_details = high_details[high_details["Employee.1"].isin(highfreq)]
 
         # 筛选金额 > 200 且频次 > 5 的记录
         filtered_high = high_details.query("Total_Spend > 200 and Txn_Count > 5")